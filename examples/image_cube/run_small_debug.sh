@@ -1,11 +1,20 @@
 #!/bin/bash
 
 # Download relevant datasets - unlike other examples, these datasets are too large to place in
-if test -f "test_data_rev.zip"; then
-  echo "Test zip already present, skipping download"
+# the repository.  The archive is cached under ISOFIT_TEST_CACHE (default ~/.cache/isofit-tests)
+# so repeated runs - and the other run_*.sh scripts - skip the download entirely.
+cache_dir=${ISOFIT_TEST_CACHE:-$HOME/.cache/isofit-tests}
+if test -f "${cache_dir}/test_data_rev.zip"; then
+  echo "Test zip already cached, skipping download"
 else
-  curl -O https://avng.jpl.nasa.gov/pub/PBrodrick/isofit/test_data_rev.zip
-  unzip test_data_rev.zip
+  mkdir -p "${cache_dir}"
+  # Stream to a partial file (resuming any earlier attempt) and only rename it
+  # into place on success, so an interrupted transfer never poisons the cache
+  curl -f -C - -o "${cache_dir}/test_data_rev.zip.part" https://avng.jpl.nasa.gov/pub/PBrodrick/isofit/test_data_rev.zip \
+    && mv "${cache_dir}/test_data_rev.zip.part" "${cache_dir}/test_data_rev.zip"
+fi
+if test ! -d "small_chunk"; then
+  unzip -n "${cache_dir}/test_data_rev.zip"
 fi
 
 n_cores=4
@@ -0,0 +1,43 @@
+import numpy as np
+from isofit.utils.atm_interpolation import _regress_bhat
+
+
+def test_regress_bhat_matches_float64_reference():
+    # Realistic scaled coordinates: magnitudes near 1e8 with a small local
+    # spread, which an uncentered float32 fit cannot resolve
+    rng = np.random.default_rng(13)
+    n = 400
+    lon  = (-118.0 + rng.uniform(0, 0.05, n)) * 1e6
+    lat  = (  34.0 + rng.uniform(0, 0.05, n)) * 1e6
+    elev = rng.uniform(0, 20, n)
+    xv = np.column_stack((lon, lat, elev)).astype(np.float32)
+
+    coords = xv[:, :2].astype(np.float64)
+    slopes = np.array([[2e-6, -1e-6], [-3e-6, 5e-7]])
+    yv = np.array([0.5, 1.2]) + (coords - coords.mean(axis=0)) @ slopes.T
+    yv = (yv + rng.normal(0, 1e-4, (n, 2))).astype(np.float32)
+
+    bhat, center = _regress_bhat(xv, yv)
+
+    Xc  = np.column_stack((np.ones(n), coords - center))
+    ref = np.linalg.lstsq(Xc, yv.astype(np.float64), rcond=None)[0].T
+
+    assert np.allclose(bhat, ref, rtol=1e-5, atol=1e-12)
+    assert np.allclose(Xc @ bhat.T, yv, atol=1e-3)
+
+
+def test_regress_bhat_masks_invalid_bands():
+    rng = np.random.default_rng(7)
+    n = 50
+    xv = np.column_stack((
+        (-118.0 + rng.uniform(0, 0.05, n)) * 1e6,
+        (  34.0 + rng.uniform(0, 0.05, n)) * 1e6,
+        rng.uniform(0, 20, n)
+    )).astype(np.float32)
+    yv = np.ones((n, 2), dtype=np.float32)
+    yv[:, 1] = -9999
+
+    bhat, center = _regress_bhat(xv, yv)
+
+    assert np.allclose(bhat[0], [1, 0, 0], atol=1e-6)
+    assert np.all(bhat[1] == 0)
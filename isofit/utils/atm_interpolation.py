@@ -18,16 +18,14 @@
 # Author: Philip G. Brodrick, philip.brodrick@jpl.nasa.gov
 #
 import atexit
+import functools
 import logging
-import matplotlib
 import numpy as np
-import pylab as plt
 import ray
 import time
 
-from scipy.linalg  import inv
-from scipy.spatial import KDTree
-from scipy.ndimage import gaussian_filter
+from scipy.spatial import cKDTree
+from scipy.ndimage import gaussian_filter1d, mean as labeled_mean
 from spectral.io   import envi
 
 from isofit.configs         import configs
@@ -35,16 +33,169 @@ from isofit.core.common     import envi_header
 from isofit.core.fileio     import write_bil_chunk
 from isofit.core.instrument import Instrument
 
-plt.switch_backend('Agg')
+# Assume (heuristically) that, for distance purposes, 1 m vertically is
+# comparable to 10 m horizontally, and that there are 100 km per latitude
+# degree.  This is all approximate of course.  Elevation appears in the
+# Third element, and the first two are latitude/longitude coordinates.
+# Deliberately float64: scaled coordinates approach 1e8, where float32
+# resolution is too coarse for the regression and its evaluation - float32
+# is reserved for storage and the state vectors themselves
+loc_scaling = np.array([1e6, 1e6, 0.01])
+
+@functools.lru_cache(maxsize=None)
+def _open_envi(path: str):
+    """
+    Open an ENVI image, memoized so repeated opens of the same input file
+    within a process skip the header re-parse.
+
+    Args:
+        path: path to the ENVI data file
+
+    Returns:
+        the opened spectral image
+    """
+    return envi.open(envi_header(path), path)
+
+def _regress_bhat(xv: np.array, yv: np.array) -> tuple:
+    """
+    Fit per-band affine coefficients mapping scaled lat/lon to atmospheric state.
+
+    Args:
+        xv: scaled neighbor locations (n_neighbors, 3)
+        yv: neighbor atmospheric state (n_neighbors, n_atm_bands)
+
+    Returns:
+        regression coefficients (n_atm_bands, 3) and the lat/lon center (2,)
+        they were fit about
+    """
+    # Center the predictors and fit in float64 - the scaled coordinates sit
+    # near 1e8 with only a small spread, so the uncentered normal equations
+    # square an already-large condition number and shed most of their
+    # significant digits in lower precision
+    coords = xv[:, :2].astype(np.float64)
+    center = coords.mean(axis=0)
+    coords = coords - center
+    yv     = yv.astype(np.float64)
+
+    bhat = np.zeros((yv.shape[1], xv.shape[1]))
+
+    # Solve all bands sharing a validity mask in one multi-RHS
+    # least squares call rather than band by band
+    use_all = yv > -5
+    masks, band_groups = np.unique(use_all.T, axis=0, return_inverse=True)
+    for g in range(masks.shape[0]):
+        use   = masks[g]
+        bands = band_groups == g
+        # only use lat/lon here, ignore Z
+        X = np.concatenate((np.ones((use.sum(), 1)), coords[use]), axis=1)
+        try:
+            # Solve the 3x3 normal equations directly - one LU solve over
+            # all right-hand sides, cheaper than lstsq's SVD for this size
+            bhat[bands, :] = np.linalg.solve(X.T @ X, X.T @ yv[np.ix_(use, bands)]).T
+        except np.linalg.LinAlgError:
+            bhat[bands, :] = 0
+
+    return bhat, center
+
+def _load_reference(
+    reference_state_file    : str,
+    reference_locations_file: str
+    ) -> tuple:
+    """
+    Load the reference locations and atmospheric state bands as flat arrays.
+
+    Args:
+        reference_state_file: source file for atmospheric state (interpolation built from this)
+        reference_locations_file: source file for file locations (lon, lat, elev), (interpolation built from this)
+
+    Returns:
+        reference locations (n_reference_lines, 3) and atmospheric state (n_reference_lines, n_atm_bands)
+    """
+    reference_state_img     = _open_envi(reference_state_file)
+    reference_locations_img = _open_envi(reference_locations_file)
+
+    n_reference_lines = int(reference_state_img.metadata['lines'])
+    n_location_bands  = int(reference_locations_img.metadata['bands'])
+
+    # Store as float32 - the files are float32 on disk and the halved memory
+    # traffic matters; the scaled coordinates are promoted to float64 where
+    # they feed the regression
+    reference_locations_mm = reference_locations_img.open_memmap(interleave='bip', writable=False)
+    reference_locations    = np.array(reference_locations_mm[:, :, :], dtype=np.float32).reshape((n_reference_lines, n_location_bands))
+
+    atm_bands          = np.where(np.array([x[:4] != 'RFL_' for x in reference_state_img.metadata['band names']]))[0]
+    reference_state_mm = reference_state_img.open_memmap(interleave='bip', writable=False)
+    reference_state    = np.array(reference_state_mm[:, :, atm_bands], dtype=np.float32).reshape((n_reference_lines, len(atm_bands)))
+
+    return reference_locations, reference_state
+
+def _precompute_bhat(
+    tree                : cKDTree,
+    reference_locations : np.array,
+    reference_state     : np.array,
+    input_locations_file: str,
+    segmentation_file   : str,
+    nneighbors          : int,
+    nodata_value        : float
+    ) -> dict:
+    """
+    Precompute regression coefficients for every segment once, so workers
+    only need to evaluate the affine model rather than re-fitting it.
+
+    Args:
+        tree: KDTree built over the scaled reference locations
+        reference_locations: reference locations (lon, lat, elev), (interpolation built from this)
+        reference_state: reference atmospheric state (interpolation built from this)
+        input_locations_file: input location file (interpolate over this)
+        segmentation_file: input file noting the per-pixel segmentation used
+        nneighbors: number of neighbors to use for interpolation
+        nodata_value: nodata value of input and output
+
+    Returns:
+        dictionary mapping segment id to regression coefficients
+    """
+    # Load segmentation and input locations
+    segmentation_img = _open_envi(segmentation_file).read_band(0)
+
+    input_locations_img = _open_envi(input_locations_file)
+    input_locations     = np.array(input_locations_img.open_memmap(interleave='bip', writable=False), dtype=np.float32)
+
+    # Segments are spatially contiguous, so the neighbor set of the segment
+    # centroid stands in for the neighbor set of any member pixel
+    valid = ~np.all(input_locations == nodata_value, axis=2)
+
+    unique_ids = np.unique(segmentation_img[valid])
+
+    # Compute all segment centroids with labeled means, then resolve every
+    # neighbor set with one batched, multithreaded tree query
+    labels    = np.where(valid, segmentation_img, -1).astype(np.int64)
+    index     = unique_ids.astype(np.int64)
+    centroids = np.column_stack([
+        labeled_mean(input_locations[..., b], labels=labels, index=index)
+        for b in range(input_locations.shape[-1])
+    ])
+
+    dists, nns = tree.query(centroids * loc_scaling, nneighbors, workers=-1)
+
+    bhat_table = {}
+    for i in range(len(unique_ids)):
+        xv = reference_locations[nns[i], :]*loc_scaling[np.newaxis,:]
+        yv = reference_state[nns[i], :]
+
+        bhat_table[unique_ids[i]] = _regress_bhat(xv, yv)
+
+    return bhat_table
 
 @ray.remote
 def _run_chunk(
     start_line              : int,
     stop_line               : int,
-    reference_state_file    : str,
-    reference_locations_file: str,
+    tree                    : cKDTree,
+    reference_locations     : np.array,
+    reference_state         : np.array,
     input_locations_file    : str,
     segmentation_file       : str,
+    bhat_table              : dict,
     output_atm_file         : str,
     nneighbors              : int,
     nodata_value            : float,
@@ -55,13 +206,13 @@ def _run_chunk(
     Args:
         start_line: line to start empirical line run at
         stop_line:  line to stop empirical line run at
-        reference_radiance_file: source file for radiance (interpolation built from this)
-        reference_reflectance_file:  source file for reflectance (interpolation built from this)
-        reference_uncertainty_file:  source file for uncertainty (interpolation built from this)
-        reference_locations_file:  source file for file locations (lon, lat, elev), (interpolation built from this)
+        tree: KDTree built over the scaled reference locations
+        reference_locations: reference locations (lon, lat, elev), (interpolation built from this)
+        reference_state: reference atmospheric state (interpolation built from this)
         input_radiance_file: input radiance file (interpolate over this)
         input_locations_file: input location file (interpolate over this)
         segmentation_file: input file noting the per-pixel segmentation used
+        bhat_table: precomputed per-segment regression coefficients
         isofit_config: path to isofit configuration JSON file
         output_reflectance_file: location to write output reflectance to
         output_uncertainty_file: location to write output uncertainty to
@@ -81,100 +232,77 @@ def _run_chunk(
         datefmt  = '%Y-%m-%d,%H:%M:%S'
     )
 
-    # Load reference images
-    reference_state_img     = envi.open(envi_header(reference_state_file)    , reference_state_file    )
-    reference_locations_img = envi.open(envi_header(reference_locations_file), reference_locations_file)
-
-    n_reference_lines, n_state_bands, n_reference_columns = [
-        int(reference_state_img.metadata[n])
-        for n in ('lines', 'bands', 'samples')
-    ]
+    # The tree, reference locations, and reference state arrive through the
+    # object store - they are built / loaded once in atm_interpolation
+    n_atm_bands = reference_state.shape[1]
 
     # Load input images
-    input_locations_img = envi.open(envi_header(input_locations_file), input_locations_file)
-    n_location_bands    = int(input_locations_img.metadata['bands'])
+    input_locations_img = _open_envi(input_locations_file)
     n_input_samples     = input_locations_img.shape[1]
     n_input_lines       = input_locations_img.shape[0]
 
-    # Load output images
-
-    # Load reference data
-    reference_locations_mm = reference_locations_img.open_memmap(interleave='bip', writable=False)
-    reference_locations    = np.array(reference_locations_mm[:, :, :]).reshape((n_reference_lines, n_location_bands))
-
-    atm_bands          = np.where(np.array([x[:4] != 'RFL_' for x in reference_state_img.metadata['band names']]))[0]
-    n_atm_bands        = len(atm_bands)
-    reference_state_mm = reference_state_img.open_memmap(interleave='bip', writable=False)
-    reference_state    = np.array(reference_state_mm[:, :, atm_bands]).reshape((n_reference_lines, n_atm_bands))
-
     # Load segmentation data
     if segmentation_file:
-        segmentation_img = envi.open(envi_header(segmentation_file), segmentation_file)
+        segmentation_img = _open_envi(segmentation_file)
         segmentation_img = segmentation_img.read_band(0)
     else:
         segmentation_img = None
 
-    # Load Tree
-    loc_scaling    = np.array([1e6, 1e6, 0.01])
-    scaled_ref_loc = reference_locations * loc_scaling
-    tree = KDTree(scaled_ref_loc)
-    # Assume (heuristically) that, for distance purposes, 1 m vertically is
-    # comparable to 10 m horizontally, and that there are 100 km per latitude
-    # degree.  This is all approximate of course.  Elevation appears in the
-    # Third element, and the first two are latitude/longitude coordinates
-
-    # Iterate through image
-    hash_table = {}
+    # Iterate through image.  Seed the cache with the shared precomputed
+    # per-segment coefficients; local regression remains as a fallback
+    hash_table = dict(bhat_table)
+    input_locations_mm = input_locations_img.open_memmap(interleave='bip', writable=False)
     for row in np.arange(start_line, stop_line):
         # Load inline input data
-        input_locations_mm = input_locations_img.open_memmap(interleave='bip', writable=False)
-        input_locations = np.array(input_locations_mm[row, :, :])
-        output_atm_row  = np.zeros((n_input_samples, len(atm_bands))) + nodata_value
+        input_locations = np.array(input_locations_mm[row, :, :], dtype=np.float32)
+        output_atm_row  = np.zeros((n_input_samples, n_atm_bands), dtype=np.float32) + nodata_value
         nspectra, start = 0, time.time()
 
-        for col in np.arange(n_input_samples):
-            x = input_locations[col, :]
-
-            if np.isclose(x, nodata_value).all():
-                output_atm_row[col, :] = nodata_value
-                continue
-            else:
-                x *= loc_scaling
-
-            bhat = None
-            hash_idx = segmentation_img[row, col]
-            if hash_idx in hash_table:
-                bhat = hash_table[hash_idx]
-
-            if bhat is None:
-                dists, nn = tree.query(x, nneighbors)
+        # Nodata is written exactly, so a plain equality test replaces the
+        # heavier per-element isclose
+        valid = ~np.all(input_locations == nodata_value, axis=1)
+        if not valid.any():
+            # Entire row is nodata - write it out and move on
+            write_bil_chunk(
+                output_atm_row.transpose((1, 0)),
+                output_atm_file,
+                row,
+                (n_input_lines, n_atm_bands, n_input_samples)
+            )
+            continue
+
+        valid_cols  = np.flatnonzero(valid)
+        scaled_locs = input_locations[valid_cols, :] * loc_scaling
+
+        # Group pixels by segment so coefficients are fetched (or fit)
+        # once per segment and the model is evaluated for all pixels in
+        # the row with a single batched matmul
+        seg_row = segmentation_img[row, valid_cols]
+        seg_ids, first_idx, inverse = np.unique(seg_row, return_index=True, return_inverse=True)
+
+        # The shared table normally covers every segment in the scene, so
+        # only query the tree for ids it is missing - one representative
+        # pixel per segment, in a single batched call
+        missing = [i for i in range(len(seg_ids)) if seg_ids[i] not in hash_table]
+        if missing:
+            dists, nns = tree.query(scaled_locs[first_idx[missing], :], nneighbors)
+            for j in range(len(missing)):
+                nn = nns[j]
                 xv = reference_locations[nn, :]*loc_scaling[np.newaxis,:]
                 yv = reference_state[nn, :]
 
-                bhat = np.zeros((n_atm_bands, xv.shape[1]))
+                hash_table[seg_ids[missing[j]]] = _regress_bhat(xv, yv)
 
-                for i in np.arange(n_atm_bands):
-                    use = yv[:, i] > -5
-                    n = sum(use)
-                    # only use lat/lon here, ignore Z
-                    X = np.concatenate((np.ones((n, 1)), xv[use, :-1]), axis=1)
-                    W = np.diag(np.ones(n))  # /uv[use, i])
-                    y = yv[use, i:i + 1]
-                    try:
-                        bhat[i, :] = (inv(X.T @ W @ X) @ X.T @ W @ y).T
-                    except:
-                        bhat[i, :] = 0
+        bhats   = np.stack([hash_table[hash_idx][0] for hash_idx in seg_ids])
+        centers = np.stack([hash_table[hash_idx][1] for hash_idx in seg_ids])
 
-                    #if i == 0:
-                    #    print(X, y, bhat)
+        # Evaluate about each segment's own center so the intercept and the
+        # coordinate terms stay at comparable magnitudes
+        coords = scaled_locs[:, :2].astype(np.float64) - centers[inverse]
+        A_all  = np.column_stack((np.ones(len(valid_cols)), coords))
+        output_atm_row[valid_cols, :] = np.einsum('pf,pbf->pb', A_all, bhats[inverse])
 
-            if (segmentation_img is not None) and not (hash_idx in hash_table):
-                hash_table[hash_idx] = bhat
-
-            A = np.hstack((np.ones(1), x[:-1]))
-            output_atm_row[col,:] = (bhat.T * A[:,np.newaxis]).sum(axis=0)
-
-            nspectra = nspectra + 1
+        nspectra = len(valid_cols)
 
         elapsed = float(time.time() - start)
         logging.debug('row {}/{}, ({}/{} local), {} spectra per second'.format(
@@ -185,8 +313,6 @@ def _run_chunk(
             round(float(nspectra) / elapsed, 2)
         ))
 
-        del input_locations_mm
-
         output_atm_row = output_atm_row.transpose((1, 0))
 
         write_bil_chunk(
@@ -257,6 +383,7 @@ def atm_interpolation(
     output_metadata['description'] = 'Interpolated atmospheric state'
     output_metadata['bands']       = len(band_names)
     output_metadata['bbl']         = '{' + ','.join([str(1) for n in range(len(band_names))]) + '}'
+    output_metadata['data type']   = 4
 
     del output_metadata['fwhm']
     del output_metadata['wavelength']
@@ -268,10 +395,13 @@ def atm_interpolation(
 
     # Initialize ray cluster
     start_time = time.time()
-    ray.init(
-        ignore_reinit_error = True,
-        local_mode          = n_cores == 1
-    )
+    rayargs = {
+        'ignore_reinit_error': True,
+        'local_mode'         : n_cores == 1
+    }
+    if n_cores != -1:
+        rayargs['num_cpus'] = n_cores
+    ray.init(**rayargs)
 
     atexit.register(ray.shutdown)
 
@@ -280,22 +410,56 @@ def atm_interpolation(
 
     logging.info(f'Beginning atmospheric interpolation {n_cores} cores')
 
-    # Break data into sections
-    line_sections = np.linspace(0, n_input_lines, num=int(n_cores + 1), dtype=int)
+    # Load the reference set and build the tree once; workers receive these
+    # through the object store rather than re-reading and re-building
+    reference_locations, reference_state = _load_reference(reference_state_file, reference_locations_file)
+    # Reference points are roughly uniformly distributed for pushbroom
+    # imagery, so skip the balancing work at negligible query-time cost
+    tree = cKDTree(reference_locations * loc_scaling, leafsize=32, balanced_tree=False, compact_nodes=False)
+
+    tree_ref      = ray.put(tree)
+    ref_loc_ref   = ray.put(reference_locations)
+    ref_state_ref = ray.put(reference_state)
+
+    # Fit each segment's regression once up front and share the table with
+    # all workers through the object store
+    if segmentation_file:
+        bhat_table = _precompute_bhat(
+            tree, reference_locations, reference_state,
+            input_locations_file, segmentation_file,
+            nneighbors, nodata_value
+        )
+    else:
+        bhat_table = {}
+    bhat_ref = ray.put(bhat_table)
+
+    # Break data into sections - use several chunks per core so Ray can
+    # load-balance around slow regions instead of idling on a straggler
+    n_chunks      = min(4 * n_cores, n_input_lines)
+    line_sections = np.linspace(0, n_input_lines, num=int(n_chunks + 1), dtype=int)
 
     start_time = time.time()
 
     # Run the pool (or run serially)
     args = (
-        reference_state_file, reference_locations_file,
-        input_locations_file, segmentation_file, output_atm_file,
+        tree_ref, ref_loc_ref, ref_state_ref,
+        input_locations_file, segmentation_file, bhat_ref, output_atm_file,
         nneighbors, nodata_value, loglevel, logfile
     )
     results = [
         _run_chunk.remote(line_sections[l], line_sections[l + 1], *args)
         for l in range(len(line_sections) - 1)
     ]
-    _ = ray.get(results)
+
+    # Collect chunks as they finish so progress is visible and a failed
+    # worker raises immediately rather than after the slowest chunk
+    pending    = results
+    done_count = 0
+    while pending:
+        done, pending = ray.wait(pending, num_returns=1)
+        ray.get(done)
+        done_count += 1
+        logging.info(f'Interpolation chunk {done_count}/{len(results)} complete')
 
     total_time = time.time() - start_time
     logging.info('Parallel atmospheric interpolations complete.  {} s total, {} spectra/s, {} spectra/s/core'.format(
@@ -304,21 +468,29 @@ def atm_interpolation(
         line_sections[-1] * n_input_samples / total_time / n_cores
     ))
 
-    atm_img = envi.open(envi_header(output_atm_file)).open_memmap(interleave='bip').copy()
-
     if gaussian_smoothing_sigma > 0:
+        # Smooth each band in place through the memmap rather than copying
+        # the whole cube into memory and rewriting it afterwards
+        atm_img = envi.open(envi_header(output_atm_file)).open_memmap(interleave='bip', writable=True)
+
+        # The nodata pattern is shared across bands, so the mask and the
+        # denominator of the hole-filling trick only need computing once
+        null = np.any(atm_img == -9999, axis=-1)
+
+        W       = np.ones(atm_img.shape[:2], dtype=atm_img.dtype)
+        W[null] = 0
+        WW      = np.empty_like(W)
+        gaussian_filter1d(W,  gaussian_smoothing_sigma, axis=0, output=WW)
+        gaussian_filter1d(WW, gaussian_smoothing_sigma, axis=1, output=WW)
+
+        V  = np.empty_like(W)
+        VV = np.empty_like(W)
         for n in range(atm_img.shape[-1]):
-            null    = atm_img[...,n] == -9999
-            V       = atm_img[...,n]
+            np.copyto(V, atm_img[...,n])
             V[null] = 0
-            VV      = gaussian_filter(V,sigma=gaussian_smoothing_sigma)
-
-            W       = 0 * atm_img[...,n] + 1
-            W[null] = 0
-            WW      = gaussian_filter(W,sigma=gaussian_smoothing_sigma)
+            gaussian_filter1d(V,  gaussian_smoothing_sigma, axis=0, output=VV)
+            gaussian_filter1d(VV, gaussian_smoothing_sigma, axis=1, output=VV)
 
-            smoothed = VV / WW
-            atm_img[...,n] = smoothed
+            atm_img[...,n] = VV / WW
 
-        atm_img = atm_img.transpose((0,2,1))
-        write_bil_chunk(atm_img, output_atm_file, 0, atm_img.shape)
+        del atm_img
@@ -42,7 +42,7 @@ setup(name='isofit',
                'bin/sunposition'],
       install_requires=['numpy>=1.20',
                         'protobuf~=3.19.0',
-                        'scipy>=1.3.0',
+                        'scipy>=1.6.0',
                         'matplotlib>=2.2.2',
                         'scikit-learn>=0.19.1',
                         'scikit-image>=0.17.0',